@@ -4,10 +4,20 @@
 ########################################################################
 import sqlite3
 import os
+import collections
 import re
 import datetime
-import configparser
-import zlib
+import itertools
+import mmap
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Prefer Intel ISA-L's CRC32 (which is accelerated with carry-less multiplication) when it's available,
+# falling back to the reference zlib implementation. Both produce identical checksums.
+try:
+    from isal import isal_zlib as zlib
+except ImportError:
+    import zlib
 
 # The regex for finding a patches number, and date.
 PATCH_REGEX = re.compile(r"ps(\d{4})-(\d{1,2})-(\d{1,2})-(\d{4})")
@@ -18,6 +28,9 @@ FULLCLIENT_REGEX = re.compile(r"(ep)(\d*\.?\d*)")
 # The retained files, which are not in the data folder.
 RETAINED_FILES = [".ini", ".dll", ".txt", ".exe", ".cfg"]
 
+# The retained file suffixes, as a tuple for use with `str.endswith`.
+RETAINED_SUFFIXES = tuple(RETAINED_FILES)
+
 # The valid distributions
 ORIGINAL_DISTRIBUTIONS = ["us", "de", "pt", "ga", "es"]
 
@@ -49,52 +62,154 @@ INSERT OR IGNORE INTO files (distribution, patch, path, date, fileid) VALUES (
         );
 """
 
-# The query for inserting to the filedata table.
+# The query for inserting a batch of rows to the filedata table, returning the id of every checksum.
+# The `checksum` column is unique, so conflicts are resolved against its index, and the no-op update
+# ensures that an id is returned even when the checksum was already present.
 INSERT_FILEDATA_QUERY = """
-INSERT OR IGNORE INTO filedata (checksum, uncompressed_size, key) VALUES (
-            ?,
-            ?,
-            ?
-        );
+INSERT INTO filedata (checksum, uncompressed_size, key) VALUES {}
+    ON CONFLICT (checksum) DO UPDATE SET checksum = excluded.checksum
+    RETURNING checksum, id;
 """
 
-# The query for selecting from the filedata table.
-SELECT_FILEDATA_QUERY = "SELECT id FROM filedata WHERE checksum = ?;"
+# The query for selecting the files which have already been populated for a set of distributions.
+SELECT_FILES_QUERY = "SELECT distribution, patch, path FROM files WHERE distribution IN ({});"
+
+# The number of entries to checksum and insert at a time.
+BATCH_SIZE = 500
+
+# The query for selecting the ids of a batch of checksums from the filedata table. This always takes
+# `BATCH_SIZE` parameters, padded with nulls (which never match), so that the statement text is the
+# same for every batch and is only prepared once.
+SELECT_FILEDATA_QUERY = f"SELECT checksum, id FROM filedata WHERE checksum IN ({','.join('?' * BATCH_SIZE)});"
+
+# The size in bytes above which a file is memory mapped, rather than read, when computing its checksum.
+MMAP_THRESHOLD = 1 << 20
+
+# The number of distributions which may be walked ahead of the one being populated.
+WALK_AHEAD = 1
+
+# Whether every inserted file entry should be printed, rather than just the overall progress.
+VERBOSE = os.environ.get("POPULATE_VERBOSE") == "1"
+
+
+# The files collected from the archive. Rather than a dictionary per file, each field is held in its
+# own list, with a file's fields all sharing the same index.
+class Entries:
+    def __init__(self):
+        self.abspaths = []
+        self.paths = []
+        self.patches = []
+        self.dates = []
+        self.keys = []
+
+    def __len__(self):
+        return len(self.abspaths)
+
+    def append(self, abspath, path, patch, date, key):
+        self.abspaths.append(abspath)
+        self.paths.append(path)
+        self.patches.append(patch)
+        self.dates.append(date)
+        self.keys.append(key)
+
+    def subset(self, indices):
+        entries = Entries()
+        entries.abspaths = [self.abspaths[i] for i in indices]
+        entries.paths = [self.paths[i] for i in indices]
+        entries.patches = [self.patches[i] for i in indices]
+        entries.dates = [self.dates[i] for i in indices]
+        entries.keys = [self.keys[i] for i in indices]
+        return entries
+
+
+# Walks a directory tree top-down, yielding each directory's path along with the `os.DirEntry` of
+# every file inside it. Unlike `os.walk`, the directory entries are kept, so that their cached type
+# information can be reused instead of stat-ing each file again. Like `os.walk`, directories that
+# can't be read (such as a distribution that isn't present locally) are skipped.
+def walk_directory(path):
+    files = []
+    dirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry)
+    except OSError:
+        return
+    yield path, files
+    for subdir in dirs:
+        yield from walk_directory(subdir)
+
+
+# Reads the `CurrentVersion` value from the `[Version]` section of a full client's `Version.ini` file,
+# or `None` if the file doesn't exist. This is the only value that's needed, so the file is scanned for
+# it directly rather than being parsed in full.
+def read_current_version(path):
+    try:
+        infile = open(path, "rb")
+    except FileNotFoundError:
+        return None
+
+    with infile:
+        section = None
+        for line in infile:
+            line = line.strip()
+            if line.startswith(b"[") and line.endswith(b"]"):
+                section = line[1:-1].strip()
+            elif section == b"Version":
+                # Like `configparser`, a key is delimited from its value by the first `=` or `:`.
+                name, _, value = line.partition(b"=")
+                if b":" in name:
+                    name, _, value = line.partition(b":")
+                if name.strip().lower() == b"currentversion":
+                    return int(value)
+    raise KeyError(f"`CurrentVersion` is missing from the `[Version]` section of {path}")
 
 
 # Collects a distribution's files.
 def collect_distribution(absroot, path, fullclient):
-    entries = []
-    for root, dirs, files in os.walk(path):
+    entries = Entries()
+
+    # The patch and date of each full client, keyed by the full client's path. Every directory within
+    # a full client belongs to it, so its `Version.ini` and `data.sah` only need to be read once.
+    fullclients = {}
+
+    # The distribution is walked once, with the patch and date being resolved for each directory as
+    # it's visited, rather than walking each patch's directory tree again.
+    for root, files in walk_directory(path):
         patch = None
         date = None
 
         if fullclient:
-            matches = re.search(FULLCLIENT_REGEX, root)
+            matches = FULLCLIENT_REGEX.search(root)
             if matches is None:
                 continue
             episode = matches.group(2)
-            fullclient_path = ''.join(re.split(FULLCLIENT_REGEX, root)[0:3])
-
-            # If the path contains a `Version.ini` file, we should parse the patch number from that.
-            version_path = os.path.join(fullclient_path, "Version.ini")
-            if os.path.exists(version_path):
-                config = configparser.ConfigParser()
-                config.read(version_path)
-                patch = int(config["Version"]["CurrentVersion"])
-            else:
-                patch = int(episode)
-                print(f"Couldn't find `Version.ini` for full client in {fullclient_path} - "
-                      f"defaulting to episode via path ({patch})")
+            fullclient_path = ''.join(FULLCLIENT_REGEX.split(root)[0:3])
 
-            data_path = os.path.join(fullclient_path, "data.sah")
-            if os.path.exists(data_path):
-                stat = os.stat(data_path)
-                last_modified = stat.st_mtime
-                date = datetime.datetime.fromtimestamp(last_modified)
+            if fullclient_path in fullclients:
+                patch, date = fullclients[fullclient_path]
+            else:
+                # If the path contains a `Version.ini` file, we should parse the patch number from that.
+                patch = read_current_version(os.path.join(fullclient_path, "Version.ini"))
+                if patch is None:
+                    patch = int(episode)
+                    print(f"Couldn't find `Version.ini` for full client in {fullclient_path} - "
+                          f"defaulting to episode via path ({patch})")
+
+                data_path = os.path.join(fullclient_path, "data.sah")
+                try:
+                    last_modified = os.stat(data_path).st_mtime
+                    date = datetime.datetime.fromtimestamp(last_modified)
+                except FileNotFoundError:
+                    pass
+
+                fullclients[fullclient_path] = (patch, date)
 
         else:
-            matches = re.search(PATCH_REGEX, root)
+            matches = PATCH_REGEX.search(root)
             if matches is None:
                 continue
             patch = int(matches.group(1))
@@ -103,89 +218,165 @@ def collect_distribution(absroot, path, fullclient):
             year = int(matches.group(4))
             date = datetime.datetime(year, month, day)
 
-        entries.extend(collect_base(absroot, root, patch, date))
+        collect_directory(entries, absroot, root, files, patch, date)
     return entries
 
 
 def collect_base(absroot, path, patch, date):
-    entries = []
-    for root, dirs, files in os.walk(path):
-        if "data" in root:
-            files = [file for file in files if not file.endswith(".patch") and file != "game.exe"]
-            for file in files:
-                abspath = os.path.join(root, file)
-                key = os.path.relpath(abspath, absroot)
-                relfile = abspath.split("data/")[1]
-                entries.append(
-                    {
-                        "abspath": abspath,
-                        "path": f"data/{relfile}".lower(),
-                        "patch": patch,
-                        "date": date,
-                        "key": key
-                    }
-                )
-        else:
-            files = [file for file in files if file.lower().endswith(tuple(RETAINED_FILES))]
-            for file in files:
-                abspath = os.path.join(root, file)
-                key = os.path.relpath(abspath, absroot)
-                entries.append(
-                    {
-                        "abspath": abspath,
-                        "path": file.lower(),
-                        "patch": patch,
-                        "date": date,
-                        "key": key
-                    }
-                )
+    entries = Entries()
+    for root, files in walk_directory(path):
+        collect_directory(entries, absroot, root, files, patch, date)
     return entries
 
 
+# Collects the files within a single directory, which aren't in any of its subdirectories.
+def collect_directory(entries, absroot, root, files, patch, date):
+    # Resolve the directory's location once, rather than for every file inside it.
+    relroot = os.path.relpath(root, absroot)
+    parts = relroot.split(os.sep)
+    if "data" in parts:
+        data_prefix = "/".join(parts[parts.index("data") + 1:]).lower()
+        data_prefix = f"data/{data_prefix}/" if data_prefix else "data/"
+        for file in files:
+            if file.name.endswith(".patch") or file.name == "game.exe":
+                continue
+            entries.append(file.path, data_prefix + file.name.lower(), patch, date, os.path.join(relroot, file.name))
+    else:
+        for file in files:
+            name = file.name.lower()
+            if not name.endswith(RETAINED_SUFFIXES):
+                continue
+            entries.append(file.path, name, patch, date, os.path.join(relroot, file.name))
+
+
+# Reads a file, and computes its checksum and uncompressed size. Large archive files are memory mapped,
+# so that they're paged in on demand rather than copied into memory in their entirety.
+def checksum_file(path):
+    with open(path, "rb") as infile:
+        size = os.fstat(infile.fileno()).st_size
+        if size <= MMAP_THRESHOLD:
+            return zlib.crc32(infile.read()), size
+
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            return zlib.crc32(mapped), size
+
+
 def populate_database(connection, dists, entries):
     cursor = connection.cursor()
 
-    for entry in entries:
-        # For each entry, read the file data, compute a checksum, and compress the data
-        infile = open(entry["abspath"], "rb")
-        data = infile.read()
-        crc32 = zlib.crc32(data)
-        infile.close()
-        uncompressed_size = len(data)
-        key = entry["key"]
-
-        # Insert the file data.
-        cursor.execute(INSERT_FILEDATA_QUERY, (crc32, uncompressed_size, key))
-        connection.commit()
-
-        # Get the filedata id
-        cursor.execute(SELECT_FILEDATA_QUERY, (crc32,))
-        rows = cursor.fetchall()
-        fileid = rows[0][0]
-
-        # Insert the file entry for every distribution
-        for dist in dists:
-            print(f"fileid={fileid}, path={entry['path']}, dist={dist}, checksum={crc32}, patch={entry['patch']}, "
-                  f"date={entry['date']}, key={entry['key']}")
-            # Insert the file entry
-            cursor.execute(INSERT_FILE_QUERY, (dist, entry["patch"], entry["path"], entry["date"], fileid))
+    # Skip the entries which have already been populated for every distribution (i.e. when the script is
+    # being re-run), so that their files don't need to be read again.
+    cursor.execute(SELECT_FILES_QUERY.format(",".join("?" * len(dists))), dists)
+    existing = set(cursor.fetchall())
+    if existing:
+        entries = entries.subset([i for i, (patch, path) in enumerate(zip(entries.patches, entries.paths))
+                                  if not all((dist, patch, path) in existing for dist in dists)])
+
+    # Insert all of the entries within a single transaction.
+    cursor.execute("BEGIN")
+
+    # The files are read and checksummed across a pool of worker processes, while this process
+    # inserts the batches that have already been checksummed. The workers are started from a fork
+    # server, as the distributions are still being walked on other threads while this runs.
+    with ProcessPoolExecutor(mp_context=multiprocessing.get_context("forkserver")) as executor:
+        checksums = executor.map(checksum_file, entries.abspaths, chunksize=64)
+        for start in range(0, len(entries), BATCH_SIZE):
+            end = start + BATCH_SIZE
+            keys = entries.keys[start:end]
+            filedata_rows = [(crc32, size, key)
+                             for key, (crc32, size) in zip(keys, itertools.islice(checksums, len(keys)))]
+
+            # Get the filedata ids for the checksums in the batch which have already been stored.
+            batch_checksums = list({crc32 for crc32, _, _ in filedata_rows})
+            batch_checksums.extend([None] * (BATCH_SIZE - len(batch_checksums)))
+            cursor.execute(SELECT_FILEDATA_QUERY, batch_checksums)
+            fileids = dict(cursor.fetchall())
+
+            # Insert the file data only for the new checksums, keeping the first occurrence of each, as the
+            # archive contains many copies of the same file across patches and distributions.
+            new_rows = {}
+            for row in filedata_rows:
+                if row[0] not in fileids:
+                    new_rows.setdefault(row[0], row)
+            if new_rows:
+                values = ",".join(["(?, ?, ?)"] * len(new_rows))
+                cursor.execute(INSERT_FILEDATA_QUERY.format(values), list(itertools.chain(*new_rows.values())))
+                fileids.update(cursor.fetchall())
+
+            # Insert the file entry for every distribution
+            batch_fileids = [fileids[crc32] for crc32, _, _ in filedata_rows]
+            patches = entries.patches[start:end]
+            paths = entries.paths[start:end]
+            dates = entries.dates[start:end]
+            for dist in dists:
+                if VERBOSE:
+                    for fileid, path, (crc32, _, key), patch, date in zip(batch_fileids, paths, filedata_rows,
+                                                                          patches, dates):
+                        print(f"fileid={fileid}, path={path}, dist={dist}, checksum={crc32}, patch={patch}, "
+                              f"date={date}, key={key}")
+                file_rows = zip(itertools.repeat(dist), patches, paths, dates, batch_fileids)
+                cursor.executemany(INSERT_FILE_QUERY, file_rows)
+            print(f"progress: {start + len(keys)}/{len(entries)} files for {', '.join(dists)}")
 
     connection.commit()
 
 
 if __name__ == "__main__":
-    # Connect to the database
-    connection = sqlite3.connect("../archive.sqlite")
-
-    # Populate the data from the US base client into all `original` distributions, as patch 0.
-    baseclient = collect_base(ARCHIVE, ARCHIVE+"shaiya-us/original", 0, datetime.datetime(2007, 12, 18))
-    populate_database(connection, ORIGINAL_DISTRIBUTIONS, baseclient)
-
-    # Populate the distributions. This inserts files one by one. While this is very slow, at least
-    # it doesn't crash our machine from the insane amount of data being parsed.
-    for dist, path, fullclient in DISTRIBUTIONS:
-        entries = collect_distribution(ARCHIVE, ARCHIVE+path, fullclient)
-        populate_database(connection, [dist], entries)
+    # Connect to the database. Durability is traded for bulk insert speed: commits aren't synced to disk,
+    # a 256mb page cache is used, and the database is locked exclusively for the duration of the load.
+    # The tables' indexes are kept, as they each back a unique constraint that the inserts resolve their
+    # conflicts against.
+    #
+    # The rollback journal is still written to disk (and truncated after each commit), so that a process
+    # which is killed partway through a distribution's transaction leaves the existing database intact,
+    # and can be resumed by re-running the script. Without syncing, only an operating system crash or
+    # power loss could corrupt it. WAL mode isn't used, as unlike the other pragmas it's persisted in the
+    # database file, and the clientbuilder lambdas open this database from EFS, where WAL's shared memory
+    # index doesn't work. This also takes a database left in WAL mode back out of it.
+    #
+    # Transactions are only ever opened explicitly, rather than implicitly by the `sqlite3` module
+    # before each insert.
+    connection = sqlite3.connect("../archive.sqlite", isolation_level=None)
+    connection.execute("PRAGMA locking_mode = EXCLUSIVE")
+    connection.execute("PRAGMA journal_mode = TRUNCATE")
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.execute("PRAGMA temp_store = MEMORY")
+    connection.execute("PRAGMA cache_size = -262144")
+
+    with ThreadPoolExecutor(max_workers=WALK_AHEAD) as executor:
+        # The distributions are walked ahead of their population, so that the directory reads overlap
+        # with the database inserts. Only `WALK_AHEAD` walks are in flight at a time, with the next one
+        # being submitted once a distribution's entries are taken for population, so that the walked
+        # entries can't pile up in memory while earlier distributions are still being populated.
+        distributions = iter(DISTRIBUTIONS)
+        futures = collections.deque()
+
+        def walk_next(count):
+            for dist, path, fullclient in itertools.islice(distributions, count):
+                futures.append((dist, executor.submit(collect_distribution, ARCHIVE, ARCHIVE+path, fullclient)))
+
+        walk_next(WALK_AHEAD)
+
+        # Populate the data from the US base client into all `original` distributions, as patch 0.
+        baseclient = collect_base(ARCHIVE, ARCHIVE+"shaiya-us/original", 0, datetime.datetime(2007, 12, 18))
+        populate_database(connection, ORIGINAL_DISTRIBUTIONS, baseclient)
+        del baseclient
+
+        # Populate the distributions. These are populated in the order they're declared, rather than
+        # as their walks complete, so that the keys stored for duplicated files are deterministic. Each
+        # distribution's entries are released once they've been populated.
+        while futures:
+            dist, future = futures.popleft()
+            entries = future.result()
+            del future
+            walk_next(1)
+            populate_database(connection, [dist], entries)
+            del entries
+
+    # Gather statistics about the freshly loaded tables, for the query planner.
+    connection.execute("ANALYZE")
 
     # Get the last patch of Shaiya US
     cursor = connection.cursor()
@@ -203,11 +394,10 @@ if __name__ == "__main__":
 ) groups WHERE groups.rows <= 1;
 """, ('us', last_us_patch))
     rows = cursor.fetchall()
-    for row in rows:
-        path = row[0]
-        date = row[1]
-        id = row[2]
+    if VERBOSE:
+        for path, date, id in rows:
+            print(f"sheesh {path} {date} {id}")
 
-        print(f"sheesh {path} {date} {id}")
-        cursor.execute(INSERT_FILE_QUERY, ('ga', 0, path, date, id))
+    cursor.execute("BEGIN")
+    cursor.executemany(INSERT_FILE_QUERY, [('ga', 0, path, date, id) for path, date, id in rows])
     connection.commit()